@@ -1,3 +1,18 @@
 FILE_METADATA_PICKLE_FILE = "cached_times.pkl"
 
 OUTPUT_PHOTO_LIBRARY = ""
+
+# Limit in bytes on the memory used to group files while scanning, shared by
+# all the groupings a scan keeps at once. Groups are spilled to sorted runs on
+# disk once this is reached. None keeps everything in
+# memory, which is faster but grows with the size of the library.
+GROUPING_MEMORY_LIMIT = None
+
+# Limits on the I/O of scans, to run them on shared storage. None for no limit.
+IO_MAX_BYTES_PER_SEC = None
+IO_MAX_OPENS_PER_SEC = None
+# Back off while reads take longer than this many seconds on average, per
+# 64KB for larger reads
+IO_LATENCY_TARGET = None
+# Use the idle I/O scheduling class (ionice -c 3 on Linux)
+IO_IDLE_PRIORITY = False
@@ -3,6 +3,7 @@ Search for potentially duplicate files by date taken and size
 """
 
 from collections import defaultdict
+import hashlib
 import os
 import glob
 
@@ -11,16 +12,70 @@ import tqdm
 
 import PyQt5.QtWidgets as widgets
 import PyQt5.QtGui as gui
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import QAbstractListModel, QModelIndex, Qt
+
+import config
+import throttle
+from grouping import MemoryBudget, make_grouper
+from throttle import governor
+from videos import fingerprint_videos, group_videos, is_video, video_date
+
+
+def file_digest(path):
+    """Digest of a file's contents, read through the I/O governor"""
+    sha1 = hashlib.sha1()
+    with governor.open(path) as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def content_key(path):
+    """Grouping key from a file's size and contents, or its path if unreadable"""
+    try:
+        governor.charge(opens=1)
+        return "{}:{}".format(os.path.getsize(path), file_digest(path))
+    except OSError:
+        return path
+
+
+def size_key(path):
+    """Quick grouping key from a file's size, or its path if unreadable
+
+    Used for files that can't be read as images. Only files whose sizes
+    collide are hashed with content_key, during validation.
+    """
+    try:
+        governor.charge(opens=1)
+        return "size:{}".format(os.path.getsize(path))
+    except OSError:
+        return path
+
+
+def exif_date(value):
+    """YYYY-MM-DD from an EXIF date like "2020:01:31 12:00:00", or "" if missing"""
+    return str(value)[:10].replace(":", "-") if value else ""
+
+
+def folder_size(path):
+    """Total size in bytes of the files under path"""
+    size = 0
+    for folder, _, files in os.walk(path):
+        governor.charge(opens=1 + len(files))
+        size += sum(os.path.getsize(os.path.join(folder, f)) for f in files)
+    return size
 
 
 def get_info(impath, load_pixels=False):
     """Turn info about image file into a string"""
+    # Metadata lookups are charged to the I/O governor like opens
+    governor.charge(opens=1)
+    filesize = os.stat(impath).st_size
     try:
-        with Image.open(impath) as imagefile:
+        with governor.open(impath) as f, Image.open(f) as imagefile:
             if not load_pixels:
                 result = {
-                    "filesize": os.stat(impath).st_size,
+                    "filesize": filesize,
                     "filename": impath,
                     "size": imagefile.size,
                     "creation_time": imagefile.getexif().get(36867),
@@ -30,7 +85,7 @@ def get_info(impath, load_pixels=False):
                 result["hash"] = "{filesize}:{size}:{format}".format(**result)
             else:
                 result = {
-                    "filesize": os.stat(impath).st_size,
+                    "filesize": filesize,
                     "filename": impath,
                     "size": imagefile.size,
                     "creation_time": imagefile.getexif().get(36867),
@@ -42,17 +97,25 @@ def get_info(impath, load_pixels=False):
                 result["hash"] = "{filesize}:{size}:{pixel0}:{pixel1}:{format}".format(**result)
     except UnidentifiedImageError:
         result = {
-            "filesize": os.stat(impath).st_size,
+            "filesize": filesize,
             "filename": impath,
         }
-        result["hash"] = "{filesize}:{impath}".format(**result)
+        # Key other files (sidecars like .AAE, HEIC, RAW) on size for now;
+        # validation hashes the contents of those whose sizes collide
+        result["hash"] = "size:{}".format(filesize)
 
     return result
 
 
 def search(root):
-    """Generator function to crawl all files in directory"""
+    """Generator function to crawl all files in directory
+
+    Listing each folder and checking each entry are charged to the I/O
+    governor as opens.
+    """
+    governor.charge(opens=1)
     for f in glob.glob(os.path.join(root, "*")):
+        governor.charge(opens=1)
         if os.path.isdir(f):
             for result in search(f):
                 yield result
@@ -65,12 +128,159 @@ def filter_duplicates(hashes):
     return {k: v for k, v in hashes.items() if len(v) > 1}
 
 
+def folder_sort_key(path):
+    """Sort key that keeps the contents of every folder contiguous"""
+    return path.replace(os.sep, "\0")
+
+
+def _digest(text):
+    return hashlib.sha1(text.encode("utf-8", "surrogateescape")).hexdigest()
+
+
+def folder_digests(file_keys, root):
+    """Build content digests of every folder bottom-up, as a Merkle tree
+
+    file_keys is an iterable of (filename, key) pairs for all files under root,
+    ordered by folder_sort_key(filename). A folder's digest is computed from the
+    sorted digests of the files and subfolders it contains, so two folders have
+    the same digest exactly when they hold the same content, regardless of the
+    names of the files and folders within them.
+
+    Only the current chain of open folders is held in memory. Yields
+    (folder, digest, child_digests) for each folder, children before parents.
+    Folder paths are normalized with os.path.normpath.
+    """
+    root = os.path.normpath(root)
+    stack = [(root, [])]
+    for filename, key in file_keys:
+        folder = os.path.dirname(os.path.normpath(filename))
+        if folder != root and not folder.startswith(os.path.join(root, "")):
+            raise ValueError("{} is not under {}".format(filename, root))
+        # The root is an ancestor of every folder, so it stays on the stack
+        while folder != stack[-1][0] and not folder.startswith(os.path.join(stack[-1][0], "")):
+            path, children = stack.pop()
+            digest = _digest("\n".join(sorted(children)))
+            stack[-1][1].append(digest)
+            yield path, digest, children
+
+        if folder != stack[-1][0]:
+            for part in os.path.relpath(folder, stack[-1][0]).split(os.sep):
+                stack.append((os.path.join(stack[-1][0], part), []))
+
+        stack[-1][1].append(_digest(key))
+
+    while stack:
+        path, children = stack.pop()
+        digest = _digest("\n".join(sorted(children)))
+        if stack:
+            stack[-1][1].append(digest)
+        yield path, digest, children
+
+
+def _within(path, folders):
+    """Check if path is one of folders or inside any of them"""
+    while True:
+        if path in folders:
+            return True
+        parent = os.path.dirname(path)
+        if parent == path:
+            return False
+        path = parent
+
+
+def find_duplicate_folders(file_keys, root, similarity=0.9, max_memory=None, max_bucket=100):
+    """Find folders and subtrees that are copies of each other
+
+    file_keys is an iterable of (filename, key) as in folder_digests.
+
+    Returns two dicts mapping a group key to a list of folders. The first holds
+    identical folders, keeping only the topmost copies of a duplicated subtree
+    rather than every folder within it. The second holds near-identical folders
+    whose direct contents (files and subfolder digests) overlap with a Jaccard
+    similarity of at least `similarity`. Contents held by more than max_bucket
+    folders (e.g. an empty .nomedia in every folder) don't make folders
+    candidates on their own, but still count towards the similarity of
+    candidates sharing other contents.
+
+    With max_memory set, folder digests are grouped on disk. Finding
+    near-identical folders keeps the contents of every folder in memory, so
+    pass similarity=None to skip it in that case.
+    """
+    groups = make_grouper(max_memory)
+    digests = {}
+    contents = {}
+    for folder, digest, children in folder_digests(file_keys, root):
+        groups.add(digest, folder)
+        if similarity is not None:
+            digests[folder] = digest
+            contents[folder] = children
+
+    identical = dict(groups.duplicates())
+    groups.close()
+    duplicated = set(f for folders in identical.values() for f in folders)
+    identical = {
+        "folder:{}".format(digest): folders
+        for digest, folders in identical.items()
+        if not all(os.path.dirname(f) in duplicated for f in folders)
+    }
+    if similarity is None:
+        return identical, {}
+
+    # Count shared contents only through digests that appear in more than one
+    # folder, so the work scales with the amount of duplication. Folders inside
+    # a duplicated parent are already covered by the parent's group.
+    containing = defaultdict(set)
+    for folder, children in contents.items():
+        if os.path.dirname(folder) not in duplicated:
+            for child in children:
+                containing[child].add(folder)
+    shared = defaultdict(int)
+    # Contents too common to pair up folders by, per folder
+    common = defaultdict(set)
+    for child, folders in containing.items():
+        if len(folders) > max_bucket:
+            for folder in folders:
+                common[folder].add(child)
+            continue
+        folders = sorted(folders)
+        for i, a in enumerate(folders):
+            for b in folders[i + 1:]:
+                shared[a, b] += 1
+
+    sizes = {folder: len(set(children)) for folder, children in contents.items()}
+    linked = {}
+
+    def find(f):
+        while linked[f] != f:
+            f = linked[f]
+        return f
+
+    for (a, b), n in shared.items():
+        if digests[a] == digests[b]:
+            continue
+        n += len(common.get(a, set()) & common.get(b, set()))
+        if n / (sizes[a] + sizes[b] - n) >= similarity:
+            linked.setdefault(a, a)
+            linked.setdefault(b, b)
+            linked[find(a)] = find(b)
+
+    similar = defaultdict(list)
+    for f in linked:
+        similar[find(f)].append(f)
+    similar = {
+        "similar:{}".format(_digest(key)): sorted(folders)
+        for key, folders in similar.items()
+    }
+
+    return identical, similar
+
+
 def pretty(info):
     """Pretty print of exif data"""
     string = """
     Taken: {}
     Source: {}
-    """.format(info["exif"].get(36867), info["exif"].get(42036))
+    """.format(info.get("exif", {}).get(36867), info.get("exif", {}).get(42036))
     return string
 
 
@@ -98,13 +308,147 @@ class SelectionWindow(widgets.QWidget):
         self.layout.addWidget(button)
 
 
+class FolderWindow(widgets.QWidget):
+    """Panel for a single duplicated folder"""
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.init_ui()
+
+    def init_ui(self):
+        self.layout = widgets.QVBoxLayout()
+        self.setLayout(self.layout)
+
+        n_files = sum(len(files) for _, _, files in os.walk(self.path))
+        self.layout.addWidget(widgets.QLabel(self.path))
+        self.layout.addWidget(widgets.QLabel("Folder with {} files".format(n_files)))
+        self.layout.addStretch()
+
+        button = widgets.QPushButton("Remove")
+        self.layout.addWidget(button)
+
+
+def _format_bytes(n):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if n < 1024:
+            return "{:.0f}{}".format(n, unit)
+        n /= 1024
+    return "{:.1f}TB".format(n)
+
+
+class DuplicateGroupModel(QAbstractListModel):
+    """List model over duplicate groups, built for hundreds of thousands of groups
+
+    Rows are handed to the view in batches as it scrolls (canFetchMore /
+    fetchMore) and labels are only built for rows the view asks to display.
+    sizes (bytes per copy) and dates (date taken, as YYYY-MM-DD) map group
+    keys to what was found during the scan, so filtering and sorting never
+    touch the disk. Groups missing from them count as 0 bytes and undated.
+    """
+
+    FILTERS = ["Folder", "Min size (MB)", "Date"]
+
+    def __init__(self, hashes, sizes=None, dates=None, batch_size=200):
+        super().__init__()
+        self.hashes = hashes
+        self.keys = list(hashes.keys())
+        self.sizes = sizes or {}
+        self.dates = dates or {}
+        self.batch_size = batch_size
+        self._visible = list(range(len(self.keys)))
+        self._fetched = min(self.batch_size, len(self._visible))
+        self._filter = (None, "")
+        self._sort_order = None
+
+    def key(self, row):
+        return self.keys[self._visible[row]]
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self._fetched
+
+    def canFetchMore(self, parent):
+        return not parent.isValid() and self._fetched < len(self._visible)
+
+    def fetchMore(self, parent):
+        n = min(self.batch_size, len(self._visible) - self._fetched)
+        self.beginInsertRows(QModelIndex(), self._fetched, self._fetched + n - 1)
+        self._fetched += n
+        self.endInsertRows()
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or role != Qt.DisplayRole:
+            return None
+        i = self._visible[index.row()]
+        paths = self.hashes[self.keys[i]]
+        return "{} copies, {} reclaimable: {}".format(
+            len(paths),
+            _format_bytes(self.reclaimable(i)),
+            ";".join([os.path.basename(f) for f in paths]),
+        )
+
+    def size(self, i):
+        """Size in bytes of one copy in group i"""
+        return self.sizes.get(self.keys[i], 0)
+
+    def reclaimable(self, i):
+        """Bytes freed by keeping a single copy in group i"""
+        return self.size(i) * (len(self.hashes[self.keys[i]]) - 1)
+
+    def date(self, i):
+        """Date the first copy in group i was taken, as YYYY-MM-DD"""
+        return self.dates.get(self.keys[i], "")
+
+    def _matches(self, i, field, text):
+        if field == "Folder":
+            return any(text in os.path.dirname(f).lower() for f in self.hashes[self.keys[i]])
+        elif field == "Min size (MB)":
+            try:
+                return self.size(i) >= float(text) * 1024 * 1024
+            except ValueError:
+                return True
+        elif field == "Date":
+            return text in self.date(i)
+
+    def set_filter(self, field, text):
+        """Show only groups matching text in the given field
+
+        When a folder search is extended (the new text contains the old), only
+        the groups still shown are searched again.
+        """
+        text = text.strip().lower()
+        old_field, old_text = self._filter
+        if field == old_field == "Folder" and old_text in text:
+            candidates = self._visible
+        else:
+            candidates = range(len(self.keys))
+
+        self.beginResetModel()
+        if text:
+            self._visible = [i for i in candidates if self._matches(i, field, text)]
+        else:
+            self._visible = list(range(len(self.keys)))
+        if self._sort_order is not None:
+            self._visible.sort(key=self.reclaimable, reverse=self._sort_order == Qt.DescendingOrder)
+        self._filter = (field, text)
+        self._fetched = min(self.batch_size, len(self._visible))
+        self.endResetModel()
+
+    def sort(self, column=0, order=Qt.DescendingOrder):
+        """Sort the shown groups by reclaimable bytes, most first by default"""
+        self.beginResetModel()
+        self._visible.sort(key=self.reclaimable, reverse=order == Qt.DescendingOrder)
+        self._sort_order = order
+        self._fetched = min(self.batch_size, len(self._visible))
+        self.endResetModel()
+
+
 class DuplicateFinder(widgets.QWidget):
     """Main window for duplicate validation gui
     """
-    def __init__(self, hashes):
+    def __init__(self, hashes, sizes=None, dates=None):
         super().__init__()
-        self.hashes = hashes
-        self.have_duplicates = list(filter_duplicates(self.hashes).keys())
+        self.hashes = filter_duplicates(hashes)
+        self.model = DuplicateGroupModel(self.hashes, sizes, dates)
         self.index = 0
         self.init_ui()
         self.render()
@@ -113,35 +457,60 @@ class DuplicateFinder(widgets.QWidget):
     def init_ui(self):
         self.setWindowTitle("DeDuper")
         self.layout = widgets.QVBoxLayout()
-        dropdown = widgets.QComboBox(self)
-        for i in range(len(self.have_duplicates)):
-            dropdown.addItem("{} {}".format(
-                i,
-                ";".join([os.path.basename(f) for f in self.hashes[self.have_duplicates[i]]])
-            ))
-        dropdown.activated.connect(self.choose_index)
+
+        self.filter_field = widgets.QComboBox(self)
+        self.filter_field.addItems(DuplicateGroupModel.FILTERS)
+        self.search = widgets.QLineEdit(self)
+        self.search.setPlaceholderText("Search")
+        self.search.textChanged.connect(self.apply_filter)
+        self.filter_field.activated.connect(self.apply_filter)
+        sort_button = widgets.QPushButton("Sort by reclaimable space")
+        sort_button.clicked.connect(lambda: self.model.sort())
+
+        self.list_view = widgets.QListView(self)
+        self.list_view.setUniformItemSizes(True)
+        self.list_view.setModel(self.model)
+        self.list_view.setMaximumHeight(200)
+        self.list_view.selectionModel().currentRowChanged.connect(
+            lambda current, previous: self.choose_index(current.row()))
+
+        self.topBar = widgets.QHBoxLayout()
+        self.topBar.addWidget(self.filter_field)
+        self.topBar.addWidget(self.search)
+        self.topBar.addWidget(sort_button)
 
         self.selection_layout = widgets.QHBoxLayout()
-        self.layout.addWidget(dropdown)
+        self.layout.addLayout(self.topBar)
+        self.layout.addWidget(self.list_view)
         self.layout.addLayout(self.selection_layout)
         self.setLayout(self.layout)
 
+    def apply_filter(self, *args):
+        self.model.set_filter(self.filter_field.currentText(), self.search.text())
+
     def set_images(self, images):
         """Update the images shown"""
         for path in images:
-            self.selection_layout.addWidget(SelectionWindow(path))
+            if os.path.isdir(path):
+                self.selection_layout.addWidget(FolderWindow(path))
+            else:
+                self.selection_layout.addWidget(SelectionWindow(path))
 
     def choose_index(self, idx):
         """Choose a different set of images"""
         for i in reversed(range(self.selection_layout.count())):
             w = self.selection_layout.itemAt(i).widget()
-            if isinstance(w, SelectionWindow):
+            if isinstance(w, (SelectionWindow, FolderWindow)):
                 w.deleteLater()
-        self.index = idx % len(self.have_duplicates)
+        if idx < 0 or not self.model.rowCount():
+            return
+        self.index = idx % self.model.rowCount()
         self.render()
 
     def render(self):
-        k = self.have_duplicates[self.index]
+        if not self.model.rowCount():
+            return
+        k = self.model.key(self.index)
         v = self.hashes[k]
         self.set_images(v)
 
@@ -150,28 +519,72 @@ if __name__ == "__main__":
     import sys
     impath = sys.argv[1]
 
+    throttle.configure_from_config()
+
+    # With a memory limit, groups spill to disk and only duplicates are kept in
+    # memory. The groupers open at once all share the one limit.
+    max_memory = MemoryBudget(config.GROUPING_MEMORY_LIMIT) if config.GROUPING_MEMORY_LIMIT else None
+
     print("Searching for duplicates")
-    hashes = defaultdict(list)
+    hashes = make_grouper(max_memory)
+    # Final grouping key of every file, in folder order for find_duplicate_folders
+    file_keys = make_grouper(max_memory)
+    # Videos are fingerprinted in a batch below
+    videos = make_grouper(max_memory)
+    n_videos = 0
     progressbar = tqdm.tqdm(search(impath))
     _duplicates_found = 0
     for filename in progressbar:
-        progressbar.set_description("Duplicates Found: {}. Looking in {}".format(_duplicates_found, os.path.dirname(filename)))
+        if max_memory:
+            progressbar.set_description("Looking in {}".format(os.path.dirname(filename)))
+        else:
+            progressbar.set_description("Duplicates Found: {}. Looking in {}".format(_duplicates_found, os.path.dirname(filename)))
+        progressbar.set_postfix_str(governor.describe(), refresh=False)
+        if is_video(filename):
+            videos.add(filename, None)
+            n_videos += 1
+            file_keys.add(folder_sort_key(filename), (filename, filename))
+            continue
         try:
             info = get_info(filename)
         except:
-            hashes[filename].append(filename)
+            key = size_key(filename)
+            hashes.add(key, filename)
+            file_keys.add(folder_sort_key(filename), (filename, key))
         else:
-            if info["hash"] in hashes:
+            if not max_memory and info["hash"] in hashes:
                 _duplicates_found += 1
-            hashes[info["hash"]].append(filename)
+            hashes.add(info["hash"], filename)
+            file_keys.add(folder_sort_key(filename), (filename, info["hash"]))
+
+    print("Validating potential duplicates")
+    hashes2 = make_grouper(max_memory)
+    # Size of one copy and date taken of every potential duplicate, for the GUI
+    sizes = {}
+    dates = {}
+    progressbar = tqdm.tqdm(hashes.duplicates())
+    for k, v in progressbar:
+        progressbar.set_postfix_str(governor.describe(), refresh=False)
+        if k.startswith("size:"):
+            # Files that aren't readable images only match on their contents
+            for filename in v:
+                key = content_key(filename)
+                hashes2.add(key, filename)
+                file_keys.add(folder_sort_key(filename), (filename, key))
+                sizes.setdefault(key, int(k[len("size:"):]))
+            continue
 
-    hashes = filter_duplicates(hashes)
-    print("Validating {} potential duplicates".format(len(hashes)))
-    hashes2 = defaultdict(list)
-    for k, v in tqdm.tqdm(list(filter_duplicates(hashes).items())):
         # If all the filenames in v have the same creation date, we're good
-        if len(set([get_info(filename)["creation_time"] for filename in v])) == 1:
-            hashes2[k] = v
+        try:
+            infos = [get_info(filename) for filename in v]
+        except:
+            # Unreadable now, compare them file by file below
+            infos = []
+        if infos and len(set([info.get("creation_time") for info in infos])) == 1:
+            for filename in v:
+                hashes2.add(k, filename)
+            sizes[k] = infos[0]["filesize"]
+            dates[k] = exif_date(infos[0].get("creation_time"))
             continue
 
         ## If not, we include some pixel info in the hash (excluded before because its much slower)
@@ -179,14 +592,63 @@ if __name__ == "__main__":
             try:
                 info = get_info(filename, load_pixels=True)
             except:
-                hashes2[filename].append(filename)
+                key = content_key(filename)
+                hashes2.add(key, filename)
+                file_keys.add(folder_sort_key(filename), (filename, key))
             else:
-                hashes2[info["hash"]].append(filename)
-
-    hashes2 = filter_duplicates(hashes2)
-    print("Identified {} duplicates".format(len(hashes2)))
+                key = info["hash"]
+                if key.startswith("size:"):
+                    key = content_key(filename)
+                hashes2.add(key, filename)
+                file_keys.add(folder_sort_key(filename), (filename, key))
+                sizes.setdefault(key, info["filesize"])
+                dates.setdefault(key, exif_date(info.get("creation_time")))
+    hashes.close()
+
+    duplicates = dict(hashes2.duplicates())
+    hashes2.close()
+    sizes = {k: v for k, v in sizes.items() if k in duplicates}
+    dates = {k: v for k, v in dates.items() if k in duplicates}
+    print("Identified {} duplicates".format(len(duplicates)))
+
+    print("Fingerprinting {} videos".format(n_videos))
+    video_groups = group_videos(
+        tqdm.tqdm(fingerprint_videos(filename for filename, _ in videos.groups()), total=n_videos),
+        max_memory=max_memory,
+    )
+    videos.close()
+    for k, v in video_groups.items():
+        for filename in v:
+            # Copies of a clip count as the same content in folder digests
+            file_keys.add(folder_sort_key(filename), (filename, k))
+        governor.charge(opens=1)
+        sizes[k] = os.path.getsize(v[0])
+        dates[k] = video_date(v[0])
+    duplicates.update(video_groups)
+    print("Identified {} duplicated videos".format(len(video_groups)))
+
+    print("Searching for duplicated folders")
+    identical, similar = find_duplicate_folders(
+        # A file re-keyed during validation was added again, the last key wins
+        (entries[-1] for _, entries in file_keys.groups()),
+        impath,
+        similarity=None if max_memory else 0.9,
+        max_memory=max_memory,
+    )
+    file_keys.close()
+    folders = set(f for group in list(identical.values()) + list(similar.values()) for f in group)
+    # Files whose copies all sit inside duplicated folders are reviewed with those folders
+    duplicates = {
+        k: v for k, v in duplicates.items()
+        if not all(_within(os.path.dirname(os.path.normpath(f)), folders) for f in v)
+    }
+    print("Identified {} duplicated and {} near-identical folders, {} remaining file duplicates".format(
+        len(identical), len(similar), len(duplicates)))
+    for k, v in list(identical.items()) + list(similar.items()):
+        sizes[k] = folder_size(v[0])
+    duplicates = {**identical, **similar, **duplicates}
     print("Launching GUI...")
 
     app = widgets.QApplication(sys.argv)
-    ex = DuplicateFinder(hashes2)
+    ex = DuplicateFinder(duplicates, sizes, dates)
     sys.exit(app.exec_())
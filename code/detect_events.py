@@ -8,7 +8,6 @@ this is true or not, see if we can figure out a good way to group these too)
 
 import datetime
 import os
-import pickle
 import subprocess
 import sys
 from collections import defaultdict
@@ -24,6 +23,8 @@ from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg
 import config
 from cmdline_utils import yes_no
 from date_utils import CalendarMonthGrid
+from results_cache import load_cached_results
+from geo_utils import cluster_events
 from plotting_utils import line2d_seg_dist
 
 
@@ -37,11 +38,8 @@ def load_creation_times(root):
         else:
             sys.exit(0)
 
-    with open(config.FILE_METADATA_PICKLE_FILE, "rb") as picklefile:
-        results = pickle.load(picklefile)
-
-    results, lone_aae, aae_img_map = results
-    return results, lone_aae, aae_img_map
+    results, lone_aae, aae_img_map, gps = load_cached_results()
+    return results, lone_aae, aae_img_map, gps
 
 
 class Thumbnail(widgets.QWidget):
@@ -276,7 +274,19 @@ class MainWindow(widgets.QWidget):
 
 if __name__ == "__main__":
     impath = sys.argv[1]
-    results, lone_aae, aae_img_map = load_creation_times(impath)
+    results, lone_aae, aae_img_map, gps = load_creation_times(impath)
+
+    # Group geotagged photos into outings (nearby within a few hours)
+    # and trips (within a day's travel of each other)
+    timestamps = np.array([r[0].timestamp() if r[0] else np.nan for r in results])
+    outings = cluster_events(gps[:, 0], gps[:, 1], timestamps)
+    trips = cluster_events(gps[:, 0], gps[:, 1], timestamps, distance=50000.0, time_gap=86400)
+    print("Found {} outings and {} trips among {} geotagged photos".format(
+        len(np.unique(outings[outings >= 0])),
+        len(np.unique(trips[trips >= 0])),
+        np.count_nonzero(outings >= 0),
+    ))
+
     results = sorted([r for r in results if r[0] is not None])
 
     # Plot some summaries of the data
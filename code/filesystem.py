@@ -4,10 +4,18 @@
 import os
 import glob
 
+from throttle import governor
+
 
 def search(root):
-    """Generator function to crawl all files in directory"""
+    """Generator function to crawl all files in directory
+
+    Listing each folder and checking each entry are charged to the I/O
+    governor as opens.
+    """
+    governor.charge(opens=1)
     for f in glob.glob(os.path.join(root, "*")):
+        governor.charge(opens=1)
         if os.path.isdir(f):
             for result in search(f):
                 yield result
@@ -0,0 +1,129 @@
+"""Utility functions for working with photo GPS coordinates
+"""
+
+import itertools
+
+import numpy as np
+
+
+EARTH_RADIUS = 6371008.8  # meters
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Great circle distance(s) in meters between points given in degrees"""
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def to_cartesian(lat, lon):
+    """Project lat/lon (degrees) onto a sphere the size of the earth
+
+    Returns an (n, 3) array of x, y, z in meters. The straight line (chord)
+    distance between two projected points is a monotonic function of their
+    haversine distance, so a regular grid over these coordinates can be used
+    to find nearby photos anywhere on the globe.
+    """
+    lat = np.radians(np.asarray(lat, dtype=float))
+    lon = np.radians(np.asarray(lon, dtype=float))
+    cos_lat = np.cos(lat)
+    return EARTH_RADIUS * np.stack([
+        cos_lat * np.cos(lon),
+        cos_lat * np.sin(lon),
+        np.sin(lat),
+    ], axis=-1)
+
+
+def _connected_components(n, src, dst):
+    """Label the connected components of a graph given as edge arrays
+
+    Repeatedly hooks the larger label of every edge onto the smaller one, then
+    compresses paths with pointer jumping until each node points at the root.
+    """
+    labels = np.arange(n)
+    while True:
+        low = np.minimum(labels[src], labels[dst])
+        high = np.maximum(labels[src], labels[dst])
+        changed = low != high
+        if not np.any(changed):
+            return labels
+        np.minimum.at(labels, high[changed], low[changed])
+        while True:
+            jumped = labels[labels]
+            if np.array_equal(jumped, labels):
+                break
+            labels = jumped
+
+
+def _hash_cells(cells):
+    """64-bit hash of each row of an (n, 4) int64 array of grid cells"""
+    h = np.zeros(len(cells), dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        for column in cells.astype(np.uint64).T:
+            # splitmix64 style mixing of each coordinate into the hash
+            h = (h ^ column) * np.uint64(0x9E3779B97F4A7C15)
+            h ^= h >> np.uint64(31)
+            h *= np.uint64(0xBF58476D1CE4E5B9)
+            h ^= h >> np.uint64(29)
+    return h
+
+
+def cluster_events(lat, lon, timestamps, distance=1000.0, time_gap=3 * 3600):
+    """Group photos taken close together in both space and time
+
+    Each photo is hashed into a 4-d grid (x, y, z on the earth's surface and
+    time) with cells `distance` meters and `time_gap` seconds wide. Photos in
+    the same or adjacent occupied cells are linked, and chains of linked photos
+    form one event. So any two photos within `distance` and `time_gap` of each
+    other always end up together, while photos up to a few cells apart may also
+    be joined. Use a small distance and gap for outings, and larger ones
+    (e.g. 50km and a day) for trips.
+
+    lat, lon are in degrees and timestamps in seconds; missing values are NaN.
+
+    Returns an int array of event labels numbered from 0, with -1 for photos
+    missing either a location or a timestamp.
+    """
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    timestamps = np.asarray(timestamps, dtype=float)
+
+    labels = np.full(len(lat), -1, dtype=int)
+    valid = np.isfinite(lat) & np.isfinite(lon) & np.isfinite(timestamps)
+    if not np.any(valid):
+        return labels
+
+    # Convert the great circle distance to a distance along the chord
+    chord = 2 * EARTH_RADIUS * np.sin(min(distance / (2 * EARTH_RADIUS), np.pi / 2))
+    cells = np.floor(np.column_stack([
+        to_cartesian(lat[valid], lon[valid]) / chord,
+        timestamps[valid] / time_gap,
+    ])).astype(np.int64)
+
+    # Hash the occupied cells so neighbors can be looked up by sorted search,
+    # whatever the extent of the data. Neighbor matches are checked against the
+    # actual cell; two occupied cells sharing a 64-bit hash is vanishingly rare.
+    codes, first, cell_of_photo = np.unique(_hash_cells(cells), return_index=True, return_inverse=True)
+    cell_of_photo = cell_of_photo.ravel()
+    occupied = cells[first]
+
+    src = []
+    dst = []
+    for offset in itertools.product((-1, 0, 1), repeat=4):
+        # Links are undirected, so only look in one of each pair of directions
+        if offset <= (0, 0, 0, 0):
+            continue
+        neighbors = occupied + np.array(offset, dtype=np.int64)
+        idx = np.minimum(np.searchsorted(codes, _hash_cells(neighbors)), len(codes) - 1)
+        hit = np.all(occupied[idx] == neighbors, axis=1)
+        src.append(np.nonzero(hit)[0])
+        dst.append(idx[hit])
+
+    components = _connected_components(len(occupied), np.concatenate(src), np.concatenate(dst))
+    _, events = np.unique(components, return_inverse=True)
+    labels[valid] = events.ravel()[cell_of_photo]
+
+    return labels
@@ -9,21 +9,27 @@ import datetime
 import glob
 import io
 import os
-import pickle
-import pprint
+import re
 import time
 from collections import defaultdict
 
 from PIL import Image, UnidentifiedImageError
 import exifread
 import ffmpeg
+import numpy as np
 import pyheif
 import tqdm
 
 import config
+import throttle
 from filesystem import search
+from results_cache import cache_results, collect_results, iter_cached_results
+from throttle import governor
 
-pp = pprint.PrettyPrinter(indent=4)
+GPS_IFD = 34853
+
+# ISO 6709 strings as stored in video metadata, e.g. "+37.7749-122.4194+010.000/"
+_ISO6709 = re.compile(r"([+-]\d+(?:\.\d+)?)([+-]\d+(?:\.\d+)?)")
 
 
 def _time_parser(time_string):
@@ -45,22 +51,66 @@ def _time_parser(time_string):
     raise ValueError("Could not find a time parser for time {}".format(time_string))
 
 
-def detect_by_date_taken(root):
-    results = []
+def _dms_to_degrees(dms, ref):
+    """Convert exif (degrees, minutes, seconds) rationals to signed degrees"""
+    degrees = sum(float(x) / 60 ** i for i, x in enumerate(dms))
+    if str(ref).strip().upper() in ("S", "W"):
+        degrees = -degrees
+    return degrees
+
+
+def _gps_from_exif(exif):
+    """Read (lat, lon) from a PIL exif object, or (nan, nan) if not geotagged"""
+    try:
+        gps = exif.get_ifd(GPS_IFD)
+    except AttributeError:
+        # Older versions of Pillow return the GPS IFD as a dict directly
+        gps = exif.get(GPS_IFD)
+    try:
+        return _dms_to_degrees(gps[2], gps[1]), _dms_to_degrees(gps[4], gps[3])
+    except (KeyError, TypeError, ValueError, ZeroDivisionError):
+        return np.nan, np.nan
+
+
+def _gps_from_exifread(tags):
+    """Read (lat, lon) from exifread tags, or (nan, nan) if not geotagged"""
+    try:
+        return (
+            _dms_to_degrees(tags["GPS GPSLatitude"].values, tags["GPS GPSLatitudeRef"]),
+            _dms_to_degrees(tags["GPS GPSLongitude"].values, tags["GPS GPSLongitudeRef"]),
+        )
+    except (KeyError, TypeError, ValueError, ZeroDivisionError):
+        return np.nan, np.nan
+
+
+def _gps_from_ffmpeg_tags(tags):
+    """Read (lat, lon) from video container tags, or (nan, nan) if not geotagged"""
+    for key in ("location", "com.apple.quicktime.location.ISO6709"):
+        match = _ISO6709.match(tags.get(key, ""))
+        if match:
+            return float(match.group(1)), float(match.group(2))
+    return np.nan, np.nan
+
+
+def iter_date_taken(root, lone_aae, aae_img_map):
+    """Generator over the date taken and GPS location of every file under root
+
+    Yields (result, (lat, lon)) for each file, one at a time. AAE files are not
+    yielded but recorded in lone_aae and aae_img_map as they are found.
+    """
     progressbar = tqdm.tqdm(search(root))
 
     time1 = 0
     time2 = 0
     time3 = 0
 
-    lone_aae = []
-    aae_img_map = {}
-
     for filename in progressbar:
         progressbar.set_description("Looking in {}".format(os.path.dirname(filename)))
+        progressbar.set_postfix_str(governor.describe(), refresh=False)
 
         name, ext = os.path.splitext(filename)
         if ext.lower() == ".aae":
+            governor.charge(opens=1)
             corresponding_images = [f for f in glob.glob("{}*".format(name)) if f != filename]
             if not len(corresponding_images):
                 lone_aae.append(filename)
@@ -71,11 +121,13 @@ def detect_by_date_taken(root):
             continue
 
         date_taken = None
+        location = (np.nan, np.nan)
         _start = time.time()
         try:
-            with Image.open(filename) as imagefile:
+            with governor.open(filename) as f, Image.open(f) as imagefile:
                 exif = imagefile.getexif()
             date_taken = exif.get(36867, exif.get(36868))
+            location = _gps_from_exif(exif)
         except UnidentifiedImageError:
             pass
         else:
@@ -86,10 +138,15 @@ def detect_by_date_taken(root):
         _start = time.time()
         if date_taken is None:
             try:
-                date_taken = ffmpeg.probe(filename)["format"]["tags"]["creation_time"]
+                governor.charge(opens=1)
+                tags = ffmpeg.probe(filename)["format"]["tags"]
             except:
                 pass
             else:
+                # Videos without a date can still be geotagged
+                if np.isnan(location[0]):
+                    location = _gps_from_ffmpeg_tags(tags)
+                date_taken = tags.get("creation_time")
                 if date_taken is not None:
                     date_taken = _time_parser(date_taken)
         time2 += time.time() - _start
@@ -97,7 +154,7 @@ def detect_by_date_taken(root):
         _start = time.time()
         if date_taken is None:
             try:
-                with open(filename, "rb") as imagefile:
+                with governor.open(filename) as imagefile:
                     exifdata = pyheif.read_heif(imagefile).metadata[0]["data"][6:]
                 exifdata = exifread.process_file(io.BytesIO(exifdata))
                 _date_taken = exifdata.get("EXIF DateTimeOriginal")
@@ -108,24 +165,26 @@ def detect_by_date_taken(root):
             else:
                 if _date_taken is not None:
                     date_taken = _time_parser(str(_date_taken))
+                if np.isnan(location[0]):
+                    location = _gps_from_exifread(exifdata)
         time3 += time.time() - _start
 
         if date_taken:
-            results.append((
+            yield (
                 date_taken,
                 (date_taken.year, date_taken.month),
                 (date_taken.year, date_taken.month, date_taken.day),
                 os.path.dirname(filename),
                 filename
-            ))
+            ), location
         else:
-            results.append((
+            yield (
                 None,
                 None,
                 None,
                 os.path.dirname(filename),
                 filename
-            ))
+            ), location
 
     print("FinisheD")
     print("""
@@ -134,33 +193,45 @@ def detect_by_date_taken(root):
     time3: {:.2f}
     """.format(time1, time2, time3))
 
-    return results, lone_aae, aae_img_map
+
+def detect_by_date_taken(root):
+    """Find the date taken and GPS location of every file under root
+
+    Returns the per-file results, the lone and matched AAE files, and an (n, 2)
+    float array of (lat, lon) aligned with results, NaN where not geotagged.
+    """
+    lone_aae = []
+    aae_img_map = {}
+    results, gps = collect_results(iter_date_taken(root, lone_aae, aae_img_map))
+    return results, lone_aae, aae_img_map, gps
 
 
 if __name__ == "__main__":
     import sys
     impath = sys.argv[1]
 
+    throttle.configure_from_config()
+
+    lone_aae = []
+    aae_img_map = {}
     if os.path.exists(config.FILE_METADATA_PICKLE_FILE):
-        with open(config.FILE_METADATA_PICKLE_FILE, "rb") as picklefile:
-            results = pickle.load(picklefile)
+        records = iter_cached_results(lone_aae, aae_img_map)
     else:
-        results = detect_by_date_taken(impath)
-        with open(config.FILE_METADATA_PICKLE_FILE, "wb") as picklefile:
-            pickle.dump(results, picklefile)
-
-    results, lone_aae, aae_img_map = results
-
-    month_sets = defaultdict(list)
-    year_sets = defaultdict(list)
-    for result in results:
+        records = cache_results(iter_date_taken(impath, lone_aae, aae_img_map), lone_aae, aae_img_map)
+
+    # Summarize the results as they stream by instead of keeping them all
+    month_counts = defaultdict(int)
+    n_results = 0
+    n_no_timestamp = 0
+    n_gps = 0
+    for result, location in records:
+        n_results += 1
+        n_gps += bool(np.isfinite(location).all())
         if result[0] is None:
-            continue
-        month_sets[result[1]].append(result[4])
-        year_sets[result[0].year].append(result[4])
-
-    no_timestamp_results = [r for r in results if r[0] is None]
-    pp.pprint([r[4] for r in no_timestamp_results])
+            n_no_timestamp += 1
+            tqdm.tqdm.write(result[4])
+        else:
+            month_counts[result[1]] += 1
 
     print("""
     Found {} lone AAE files.
@@ -170,12 +241,14 @@ if __name__ == "__main__":
     print("""
     Found {} images.
     {} did not have timestamps.
+    {} had GPS locations.
     """.format(
-        len(results),
-        len(no_timestamp_results)
+        n_results,
+        n_no_timestamp,
+        n_gps,
     ))
 
-    sorted_month_sets = sorted(month_sets.items())
-    for month, val in sorted_month_sets:
-        print("{}: {}".format(month, len(val)))
+    sorted_month_counts = sorted(month_counts.items())
+    for month, count in sorted_month_counts:
+        print("{}: {}".format(month, count))
 
@@ -0,0 +1,193 @@
+"""Group values by key, in memory or in bounded memory with on-disk sorted runs
+"""
+
+from collections import defaultdict
+import heapq
+import itertools
+import operator
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+
+
+def make_grouper(max_memory=None):
+    """Grouper holding everything in memory, or at most max_memory bytes
+
+    max_memory may be a MemoryBudget shared with other groupers.
+    """
+    if max_memory:
+        return ExternalGrouper(max_memory)
+    return InMemoryGrouper()
+
+
+class MemoryBudget(object):
+    """Memory limit shared by the ExternalGroupers open at the same time
+
+    When the buffers of all groupers on the budget add up to max_memory, the
+    grouper with the largest buffer spills it to disk.
+    """
+    def __init__(self, max_memory):
+        self.max_memory = max_memory
+        self.used = 0
+        self._groupers = []
+
+    def register(self, grouper):
+        self._groupers.append(grouper)
+
+    def unregister(self, grouper):
+        if grouper in self._groupers:
+            self._groupers.remove(grouper)
+
+    def charge(self, n):
+        self.used += n
+        if self.used >= self.max_memory:
+            max(self._groupers, key=lambda g: g._buffer_size)._spill()
+
+
+class InMemoryGrouper(defaultdict):
+    """Dict of key to list of values, with the same interface as ExternalGrouper"""
+    def __init__(self):
+        super().__init__(list)
+
+    def add(self, key, value):
+        self[key].append(value)
+
+    def groups(self):
+        """Iterate over (key, values) in key order"""
+        return iter(sorted(self.items(), key=operator.itemgetter(0)))
+
+    def duplicates(self):
+        """Iterate over (key, values) for keys with more than one value"""
+        return ((k, v) for k, v in self.groups() if len(v) > 1)
+
+    def close(self):
+        self.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ExternalGrouper(object):
+    """Group (key, value) pairs using a bounded amount of memory
+
+    Pairs are buffered until their estimated size reaches max_memory, then
+    sorted by key and spilled to a run file on disk. With a MemoryBudget as
+    max_memory, the limit covers the buffers of every grouper sharing it.
+    Every max_open_runs runs of the same size are merged into one, and
+    reading the groups back does a k-way merge over the remaining runs, so
+    only one item per run (plus the values of the current key) is held in
+    memory at a time. Keys must be orderable and both keys and values
+    picklable.
+
+    Values for the same key come back in the order they were added.
+    """
+    def __init__(self, max_memory, max_open_runs=64, tmpdir=None):
+        if not isinstance(max_memory, MemoryBudget):
+            max_memory = MemoryBudget(max_memory)
+        self.budget = max_memory
+        self.budget.register(self)
+        self.max_open_runs = max_open_runs
+        self._dir = tempfile.mkdtemp(prefix="grouping_", dir=tmpdir)
+        self._runs = []
+        self._buffer = []
+        self._buffer_size = 0
+
+    def add(self, key, value):
+        self._buffer.append((key, value))
+        size = _sizeof(key) + _sizeof(value) + 120
+        self._buffer_size += size
+        self.budget.charge(size)
+
+    def _spill(self):
+        if not self._buffer:
+            return
+        self._buffer.sort(key=operator.itemgetter(0))
+        self._runs.append((0, self._write_run(self._buffer)))
+        self._buffer = []
+        self.budget.used -= self._buffer_size
+        self._buffer_size = 0
+
+        # Merge max_open_runs runs of the same level into one of the next
+        # level up, so every item is rewritten once per level rather than
+        # on every merge. The runs list stays in the order items were added.
+        while len(self._runs) >= self.max_open_runs:
+            level = self._runs[-1][0]
+            if any(run_level != level for run_level, _ in self._runs[-self.max_open_runs:]):
+                break
+            self._merge_newest(self.max_open_runs, level + 1)
+
+    def _merge_newest(self, n, level):
+        """Replace the n most recent runs with a single run at level"""
+        runs = [path for _, path in self._runs[-n:]]
+        merged = self._write_run(self._merge(runs))
+        for path in runs:
+            os.remove(path)
+        self._runs[-n:] = [(level, merged)]
+
+    def _write_run(self, items):
+        fd, path = tempfile.mkstemp(suffix=".run", dir=self._dir)
+        with os.fdopen(fd, "wb") as runfile:
+            pickler = pickle.Pickler(runfile, protocol=pickle.HIGHEST_PROTOCOL)
+            for item in items:
+                pickler.dump(item)
+                # Don't let the pickler's memo keep every item alive
+                pickler.clear_memo()
+        return path
+
+    def _merge(self, runs):
+        return heapq.merge(*[_read_run(path) for path in runs], key=operator.itemgetter(0))
+
+    def items(self):
+        """Iterate over all (key, value) pairs in key order"""
+        self._spill()
+        # Fold the most recent, smallest runs together until the final
+        # merge reads at most max_open_runs files
+        while len(self._runs) > self.max_open_runs:
+            n = min(self.max_open_runs, len(self._runs) - self.max_open_runs + 1)
+            self._merge_newest(n, self._runs[-n][0])
+        return self._merge([path for _, path in self._runs])
+
+    def groups(self):
+        """Iterate over (key, values) in key order"""
+        for key, items in itertools.groupby(self.items(), key=operator.itemgetter(0)):
+            yield key, [value for _, value in items]
+
+    def duplicates(self):
+        """Iterate over (key, values) for keys with more than one value"""
+        return ((k, v) for k, v in self.groups() if len(v) > 1)
+
+    def close(self):
+        shutil.rmtree(self._dir, ignore_errors=True)
+        self._runs = []
+        self._buffer = []
+        self.budget.used -= self._buffer_size
+        self._buffer_size = 0
+        self.budget.unregister(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _read_run(path):
+    with open(path, "rb") as runfile:
+        unpickler = pickle.Unpickler(runfile)
+        while True:
+            try:
+                yield unpickler.load()
+            except EOFError:
+                return
+
+
+def _sizeof(obj):
+    """Rough estimate of the memory used by a key or value"""
+    if isinstance(obj, tuple):
+        return sys.getsizeof(obj) + sum(_sizeof(x) for x in obj)
+    return sys.getsizeof(obj)
@@ -0,0 +1,322 @@
+"""
+Organize photos into the output photo library by the date they were taken
+
+Uses the results of get_creation_times.py to lay files out as year/month/day
+(or by detected event) under config.OUTPUT_PHOTO_LIBRARY. Files are hardlinked
+or renamed when the library is on the same filesystem and copied otherwise.
+Every completed transfer is recorded in a journal in the library, so an
+interrupted run can be restarted without redoing work.
+"""
+
+import argparse
+import concurrent.futures
+import errno
+import filecmp
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+import tqdm
+
+import config
+from geo_utils import cluster_events
+from results_cache import load_cached_results
+
+
+JOURNAL_FILE = ".organize_journal"
+UNDATED_FOLDER = "undated"
+
+
+def load_results():
+    """Load the cached results of get_creation_times.py"""
+    if not os.path.exists(config.FILE_METADATA_PICKLE_FILE):
+        print("No creation times found, run get_creation_times.py first")
+        sys.exit(1)
+
+    results, lone_aae, aae_img_map, gps = load_cached_results()
+    return results, gps
+
+
+def scanned_root(results):
+    """The folder containing every file in the results, or the current folder if there are none"""
+    if not results:
+        return os.getcwd()
+    return os.path.commonpath([os.path.abspath(r[3]) for r in results])
+
+
+def date_folder(date_taken):
+    """Library folder for a photo taken on date_taken"""
+    return os.path.join(
+        "{:04d}".format(date_taken.year),
+        "{:02d}".format(date_taken.month),
+        "{:02d}".format(date_taken.day),
+    )
+
+
+def event_folders(results, gps):
+    """Library folders by detected event, falling back to date for others"""
+    timestamps = np.array([r[0].timestamp() if r[0] else np.nan for r in results])
+    labels = cluster_events(gps[:, 0], gps[:, 1], timestamps)
+
+    starts = {}
+    for label, result in zip(labels, results):
+        if label >= 0 and (label not in starts or result[0] < starts[label]):
+            starts[label] = result[0]
+
+    folders = []
+    for label, result in zip(labels, results):
+        if label >= 0:
+            start = starts[label]
+            folders.append(os.path.join(
+                "{:04d}".format(start.year),
+                "{} Event {}".format(start.strftime("%Y-%m-%d"), label),
+            ))
+        elif result[0] is not None:
+            folders.append(date_folder(result[0]))
+        else:
+            folders.append(None)
+    return folders
+
+
+def read_journal(library):
+    """Map of source to destination for all transfers already completed"""
+    done = {}
+    path = os.path.join(library, JOURNAL_FILE)
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8", errors="surrogateescape") as journal:
+            for line in journal:
+                # A partially written last line from an interrupted run is ignored
+                if line.endswith("\n") and "\t" in line:
+                    src, dst = line[:-1].split("\t", 1)
+                    done[src] = dst
+    return done
+
+
+def plan(results, folders, library, done, root):
+    """Choose the destination for every file not yet transferred
+
+    Files without a date are kept at their path relative to root under the
+    undated folder, or just by name if they are not inside root. Name clashes
+    are resolved by transfer() in the workers, where the content is compared.
+    Returns a list of (src, dst) pairs.
+    """
+    root = os.path.abspath(root)
+    transfers = []
+    for result, folder in zip(results, folders):
+        src = result[4]
+        if src in done:
+            continue
+        if folder is None:
+            try:
+                relpath = os.path.relpath(os.path.abspath(src), root)
+            except ValueError:
+                # On a different drive than root
+                relpath = os.pardir
+            if relpath == os.pardir or relpath.startswith(os.pardir + os.sep):
+                relpath = os.path.basename(src)
+            dst = os.path.join(library, UNDATED_FOLDER, relpath)
+        else:
+            dst = os.path.join(library, folder, os.path.basename(src))
+        transfers.append((src, dst))
+    return transfers
+
+
+def _same_content(src, dst):
+    try:
+        return filecmp.cmp(src, dst, shallow=False)
+    except OSError:
+        return False
+
+
+def _copy_file(src, dst):
+    """Copy file contents in the kernel where possible, then file times"""
+    try:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            remaining = os.fstat(fsrc.fileno()).st_size
+            while remaining > 0:
+                copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+        if remaining > 0:
+            raise OSError(errno.EIO, "Source file changed during copy", src)
+    except (AttributeError, OSError) as e:
+        # copy_file_range is Linux only, and not supported by every filesystem
+        if isinstance(e, OSError) and e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+            raise
+        shutil.copyfile(src, dst)
+    shutil.copystat(src, dst)
+
+
+# Errors from os.link when src and dst can't share an inode
+_NO_LINK = (errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP, errno.EMLINK)
+
+
+def _rename(src, dst):
+    """Rename src to dst, raising FileExistsError rather than replacing dst
+
+    The check and the rename are separate steps, so this is only used where
+    hardlinks (which never replace) are not available.
+    """
+    if os.path.lexists(dst):
+        raise FileExistsError(errno.EEXIST, "File exists", dst)
+    os.rename(src, dst)
+
+
+def _place(src, dst, mode):
+    """Put src at dst without ever replacing an existing dst
+
+    Raises FileExistsError if dst was created in the meantime.
+    """
+    if mode in ("link", "move"):
+        try:
+            os.link(src, dst)
+        except FileExistsError:
+            raise
+        except OSError as e:
+            if e.errno not in _NO_LINK:
+                raise
+            if mode == "move" and e.errno != errno.EXDEV:
+                # No hardlinks on this filesystem, but it is still the same one
+                try:
+                    _rename(src, dst)
+                    return
+                except OSError as e:
+                    if e.errno != errno.EXDEV:
+                        raise
+        else:
+            if mode == "move":
+                os.remove(src)
+            return
+
+    # Copy to a temporary name so an interrupted copy never looks complete
+    fd, partial = tempfile.mkstemp(suffix=".part", dir=os.path.dirname(dst))
+    os.close(fd)
+    try:
+        _copy_file(src, partial)
+        try:
+            os.link(partial, dst)
+        except FileExistsError:
+            raise
+        except OSError as e:
+            if e.errno not in _NO_LINK:
+                raise
+            _rename(partial, dst)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+    if mode == "move":
+        os.remove(src)
+
+
+def _is_same_path(src, dst):
+    """Whether dst is src itself, rather than another link to the same file"""
+    return os.path.normcase(os.path.realpath(src)) == os.path.normcase(os.path.realpath(dst))
+
+
+def transfer(src, dst, mode="link"):
+    """Place src at dst in the library
+
+    mode is one of "link" (hardlink), "move" or "copy". Links and moves fall
+    back to a copy across filesystems. If dst holds different content, src
+    goes to the first free dst_1, dst_2, ... instead; if it, or one of those,
+    already holds the same content, nothing is transferred. src is never
+    removed when it already is the file in the library.
+
+    Returns the path in the library and whether anything was transferred.
+    """
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    name, ext = os.path.splitext(dst)
+    i = 0
+    candidate = dst
+    while True:
+        # lexists, so a dangling symlink counts as taken rather than free
+        if os.path.lexists(candidate):
+            if _is_same_path(src, candidate):
+                return candidate, False
+            if _same_content(src, candidate):
+                if mode == "move":
+                    os.remove(src)
+                return candidate, False
+            i += 1
+            candidate = "{}_{}{}".format(name, i, ext)
+            continue
+        try:
+            _place(src, candidate, mode)
+            return candidate, True
+        except FileExistsError:
+            # Another worker took this name first, compare against it. If the
+            # name still looks free, something there can't be seen, so move on.
+            if not os.path.lexists(candidate):
+                i += 1
+                candidate = "{}_{}{}".format(name, i, ext)
+
+
+def organize(results, folders, library, root=None, mode="link", workers=8):
+    """Transfer all files into the library in parallel, resuming from the journal
+
+    root is the folder undated files are kept relative to, by default the
+    folder containing all the results.
+    """
+    if root is None:
+        root = scanned_root(results)
+    done = read_journal(library)
+    transfers = plan(results, folders, library, done, root)
+    print("{} files already organized, {} to go".format(len(done), len(transfers)))
+
+    os.makedirs(library, exist_ok=True)
+    skipped = 0
+    errors = []
+    with open(os.path.join(library, JOURNAL_FILE), "a", encoding="utf-8", errors="surrogateescape") as journal:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(transfer, src, dst, mode): src for src, dst in transfers}
+            progressbar = tqdm.tqdm(concurrent.futures.as_completed(futures), total=len(futures))
+            for future in progressbar:
+                src = futures[future]
+                try:
+                    dst, transferred = future.result()
+                    if not transferred:
+                        skipped += 1
+                except OSError as e:
+                    errors.append((src, e))
+                    continue
+                journal.write("{}\t{}\n".format(src, dst))
+                journal.flush()
+                progressbar.set_description("Skipped {} already present. Errors: {}".format(skipped, len(errors)))
+
+    for src, e in errors:
+        print("Could not organize {}: {}".format(src, e))
+
+    return len(transfers) - skipped - len(errors), skipped, errors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("root", nargs="?",
+            help="Keep undated files relative to this folder (default: the folder holding all scanned files)")
+    parser.add_argument("--library", default=config.OUTPUT_PHOTO_LIBRARY,
+            help="Root of the output photo library (default: config.OUTPUT_PHOTO_LIBRARY)")
+    parser.add_argument("--layout", choices=["date", "event"], default="date")
+    parser.add_argument("--mode", choices=["link", "move", "copy"], default="link")
+    parser.add_argument("--workers", type=int, default=8)
+    args = parser.parse_args()
+
+    if not args.library:
+        print("Set config.OUTPUT_PHOTO_LIBRARY or pass --library")
+        sys.exit(1)
+
+    results, gps = load_results()
+    if args.layout == "event":
+        folders = event_folders(results, gps)
+    else:
+        folders = [date_folder(r[0]) if r[0] is not None else None for r in results]
+
+    transferred, skipped, errors = organize(
+        results, folders, args.library, args.root, mode=args.mode, workers=args.workers)
+    print("""
+    Organized {} files into {}.
+    {} were already present.
+    {} could not be organized.
+    """.format(transferred, args.library, skipped, len(errors)))
@@ -0,0 +1,95 @@
+"""Read and write the cache of per-file results saved by get_creation_times.py
+
+Kept apart from get_creation_times so scripts that only read the cache don't
+need the image and video libraries used to scan.
+"""
+
+import os
+import pickle
+
+import numpy as np
+
+import config
+
+
+def collect_results(records):
+    """Collect (result, location) pairs into a results list and an (n, 2) gps array"""
+    results = []
+    gps = []
+    for result, location in records:
+        results.append(result)
+        gps.append(location)
+    return results, np.array(gps, dtype=float).reshape(-1, 2)
+
+
+# First object in a cache written one result at a time by cache_results
+_CACHE_HEADER = "date_taken_stream_v1"
+
+
+def cache_results(records, lone_aae, aae_img_map, path=config.FILE_METADATA_PICKLE_FILE):
+    """Pass (result, location) pairs through, saving each to the cache as it goes by
+
+    lone_aae and aae_img_map are saved once records is exhausted, which is when
+    iter_date_taken has filled them in. The cache is written under a temporary
+    name and only moved to path when complete, so an interrupted scan never
+    leaves a partial cache behind.
+    """
+    partial = path + ".partial"
+    try:
+        with open(partial, "wb") as picklefile:
+            pickler = pickle.Pickler(picklefile, protocol=pickle.HIGHEST_PROTOCOL)
+            pickler.dump(_CACHE_HEADER)
+            for record in records:
+                pickler.dump(record)
+                # Don't let the pickler's memo keep every result alive
+                pickler.clear_memo()
+                yield record
+            pickler.dump({"lone_aae": lone_aae, "aae_img_map": aae_img_map})
+    except BaseException:
+        os.remove(partial)
+        raise
+    os.replace(partial, path)
+
+
+def iter_cached_results(lone_aae, aae_img_map, path=config.FILE_METADATA_PICKLE_FILE):
+    """Generator over the (result, location) pairs saved by cache_results
+
+    Like iter_date_taken, lone_aae and aae_img_map are filled in by the time
+    the generator is exhausted. Also reads caches written all at once by older
+    versions of get_creation_times.py.
+    """
+    with open(path, "rb") as picklefile:
+        unpickler = pickle.Unpickler(picklefile)
+        cached = unpickler.load()
+        if not isinstance(cached, str) or cached != _CACHE_HEADER:
+            results, _lone_aae, _aae_img_map = cached[:3]
+            if len(cached) == 3:
+                # Cached before GPS locations were collected
+                gps = np.full((len(results), 2), np.nan)
+            else:
+                gps = cached[3]
+            lone_aae.extend(_lone_aae)
+            aae_img_map.update(_aae_img_map)
+            for result, location in zip(results, gps):
+                yield result, tuple(location)
+            return
+
+        while True:
+            record = unpickler.load()
+            if isinstance(record, dict):
+                lone_aae.extend(record["lone_aae"])
+                aae_img_map.update(record["aae_img_map"])
+                return
+            yield record
+
+
+def load_cached_results(path=config.FILE_METADATA_PICKLE_FILE):
+    """Load the results saved by get_creation_times.py
+
+    Returns results, lone_aae, aae_img_map and gps as
+    get_creation_times.detect_by_date_taken does.
+    """
+    lone_aae = []
+    aae_img_map = {}
+    results, gps = collect_results(iter_cached_results(lone_aae, aae_img_map, path))
+    return results, lone_aae, aae_img_map, gps
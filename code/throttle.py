@@ -0,0 +1,198 @@
+"""Limit the I/O load scans put on shared storage
+
+Scans read through the module level `governor`, which is unlimited until
+configured (see configure_from_config). It enforces token bucket limits on
+bytes read and files opened per second, and backs off when reads get slower
+than a target latency, which is usually a sign the storage is busy.
+"""
+
+import io
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import config
+
+
+# Reads up to this size are timed as they are; larger ones are scaled down to
+# the time per block, so latency means the same for 8KB and 1MB reads
+LATENCY_BLOCK = 64 * 1024
+
+
+def _format_rate(n):
+    for unit in ["B", "KB", "MB"]:
+        if n < 1024:
+            return "{:.0f}{}/s".format(n, unit)
+        n /= 1024
+    return "{:.1f}GB/s".format(n)
+
+
+class TokenBucket(object):
+    """Token bucket refilled at rate tokens per second, holding up to a second's worth"""
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = rate
+        self.tokens = rate
+        self.last = time.monotonic()
+
+    def reserve(self, n):
+        """Take n tokens, returning how long to wait before using them"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        # Requests bigger than the bucket go into debt rather than waiting forever
+        self.tokens -= n
+        return max(0.0, -self.tokens / self.rate)
+
+
+class _ThrottledRaw(io.RawIOBase):
+    """Raw file whose reads are charged to and timed by a governor"""
+    def __init__(self, raw, governor):
+        self._raw = raw
+        self._governor = governor
+
+    def readinto(self, b):
+        start = time.monotonic()
+        n = self._raw.readinto(b)
+        self._governor.observe_latency(time.monotonic() - start, n or 0)
+        # Charged after the fact, so short reads at the end of a file only
+        # pay for what they returned
+        self._governor.charge(nbytes=n or 0)
+        return n
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self._raw.seek(offset, whence)
+
+    def tell(self):
+        return self._raw.tell()
+
+    def fileno(self):
+        return self._raw.fileno()
+
+    def close(self):
+        self._raw.close()
+        super().close()
+
+
+class IOGovernor(object):
+    """Bound the rate of reads and file opens of a scan
+
+    max_bytes_per_sec and max_opens_per_sec are token bucket limits, None for
+    no limit. With latency_target (seconds per read of up to LATENCY_BLOCK
+    bytes) set, the governor also tracks a moving average of read latency. While that is above the
+    target it idles for a growing share of the time, and it eases off again
+    once reads are fast.
+
+    Safe to share between threads.
+    """
+    def __init__(self, max_bytes_per_sec=None, max_opens_per_sec=None, latency_target=None):
+        self._lock = threading.Lock()
+        self.configure(max_bytes_per_sec, max_opens_per_sec, latency_target)
+
+    def configure(self, max_bytes_per_sec=None, max_opens_per_sec=None, latency_target=None):
+        with self._lock:
+            self._bytes = TokenBucket(max_bytes_per_sec) if max_bytes_per_sec else None
+            self._opens = TokenBucket(max_opens_per_sec) if max_opens_per_sec else None
+            self.latency_target = latency_target
+            self.latency = None
+            # Fraction of the time spent doing I/O rather than backing off
+            self.duty_cycle = 1.0
+            self.total_bytes = 0
+            self.total_opens = 0
+            self._window = (time.monotonic(), 0, 0)
+            self._rates = (0.0, 0.0)
+
+    def charge(self, nbytes=0, opens=0):
+        """Account for I/O about to happen, sleeping until it is allowed"""
+        with self._lock:
+            wait = 0.0
+            if self._bytes and nbytes:
+                wait = max(wait, self._bytes.reserve(nbytes))
+            if self._opens and opens:
+                wait = max(wait, self._opens.reserve(opens))
+            self.total_bytes += nbytes
+            self.total_opens += opens
+        if wait:
+            time.sleep(wait)
+
+    def observe_latency(self, seconds, nbytes=0):
+        """Record how long a read of nbytes took and back off if storage is slow"""
+        if not self.latency_target:
+            return
+        latency = seconds * LATENCY_BLOCK / max(nbytes, LATENCY_BLOCK)
+        with self._lock:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency = 0.8 * self.latency + 0.2 * latency
+            if self.latency > self.latency_target:
+                self.duty_cycle = max(0.05, self.duty_cycle * 0.7)
+            else:
+                self.duty_cycle = min(1.0, self.duty_cycle + 0.01)
+            pause = seconds * (1 / self.duty_cycle - 1)
+        if pause:
+            time.sleep(pause)
+
+    def open(self, path):
+        """Open path for binary reading, with reads charged to this governor"""
+        self.charge(opens=1)
+        return io.BufferedReader(_ThrottledRaw(io.FileIO(path, "rb"), self))
+
+    def rates(self):
+        """Bytes and opens per second over the last few seconds"""
+        with self._lock:
+            now = time.monotonic()
+            start, start_bytes, start_opens = self._window
+            if now - start >= 2:
+                self._rates = (
+                    (self.total_bytes - start_bytes) / (now - start),
+                    (self.total_opens - start_opens) / (now - start),
+                )
+                self._window = (now, self.total_bytes, self.total_opens)
+            return self._rates
+
+    def describe(self):
+        """Short summary of the effective rates for progress bars"""
+        bytes_per_sec, opens_per_sec = self.rates()
+        string = "{} {:.0f} opens/s".format(_format_rate(bytes_per_sec), opens_per_sec)
+        if self.duty_cycle < 1:
+            string += " (backing off to {:.0f}%)".format(100 * self.duty_cycle)
+        return string
+
+
+def set_idle_priority():
+    """Only do I/O when the disk is otherwise idle, where the OS supports it
+
+    Uses the idle class of ionice on Linux, and lowers the CPU priority
+    elsewhere. Processes started afterwards (e.g. ffmpeg) inherit it.
+    """
+    if sys.platform.startswith("linux"):
+        try:
+            subprocess.check_call(["ionice", "-c", "3", "-p", str(os.getpid())])
+            return
+        except (OSError, subprocess.CalledProcessError):
+            print("Could not set idle I/O priority with ionice")
+    if hasattr(os, "nice"):
+        os.nice(19)
+
+
+governor = IOGovernor()
+
+
+def configure_from_config():
+    """Apply the I/O limits in config to the module governor"""
+    governor.configure(
+        config.IO_MAX_BYTES_PER_SEC,
+        config.IO_MAX_OPENS_PER_SEC,
+        config.IO_LATENCY_TARGET,
+    )
+    if config.IO_IDLE_PRIORITY:
+        set_idle_priority()
@@ -0,0 +1,304 @@
+"""
+Fingerprint videos to find re-encoded and trimmed copies of the same clip
+
+A fingerprint is the container metadata (duration, resolution) plus a
+perceptual hash of a handful of keyframes. ffmpeg seeks straight to each
+sampled keyframe, so only a little of each video is read and long videos are
+cheap to fingerprint. Files that can't be sought in are streamed through
+ffmpeg in full instead.
+"""
+
+from collections import defaultdict
+import concurrent.futures
+import itertools
+import os
+import struct
+import threading
+
+import ffmpeg
+import numpy as np
+
+from grouping import make_grouper
+from throttle import governor
+
+
+VIDEO_EXTENSIONS = {
+    ".3gp", ".avi", ".m2ts", ".m4v", ".mkv", ".mov", ".mp4", ".mpg", ".mts", ".webm", ".wmv",
+}
+
+# ISO base media containers, which ffmpeg can only read from a pipe when the
+# index (moov box) comes before the media data
+_ISO_EXTENSIONS = {".3gp", ".m4v", ".mov", ".mp4"}
+
+# Seconds of video ffmpeg is assumed to read around each seek, to charge the
+# I/O governor for reads ffmpeg makes itself
+_SEEK_READ_SECONDS = 4
+
+# Hashes of flat frames (e.g. black fades) match each other but say nothing
+_FLAT_HASHES = {0, 2 ** 64 - 1}
+
+
+def is_video(filename):
+    return os.path.splitext(filename)[1].lower() in VIDEO_EXTENSIONS
+
+
+def video_date(filename):
+    """Date a video was recorded as YYYY-MM-DD, or "" if unknown"""
+    try:
+        governor.charge(opens=1)
+        return ffmpeg.probe(filename)["format"]["tags"]["creation_time"][:10]
+    except (ffmpeg.Error, KeyError, TypeError):
+        return ""
+
+
+def _index_at_end(f):
+    """Whether an ISO media file has its moov box after the media data"""
+    while True:
+        start = f.tell()
+        header = f.read(8)
+        if len(header) < 8:
+            return False
+        size, box = struct.unpack(">I4s", header)
+        if box == b"moov":
+            return False
+        if box == b"mdat":
+            return True
+        if size == 1:
+            size = struct.unpack(">Q", f.read(8))[0]
+        if size < 8:
+            # Malformed, or a box running to the end of the file
+            return False
+        f.seek(start + size)
+
+
+def _feed(f, stdin):
+    """Copy f into a process's stdin until it is done or stops reading"""
+    try:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            stdin.write(chunk)
+    except BrokenPipeError:
+        # ffmpeg exits as soon as it has enough frames
+        pass
+    finally:
+        try:
+            stdin.close()
+        except BrokenPipeError:
+            pass
+
+
+def dhash(frames):
+    """64-bit difference hashes of 8x9 grayscale frames, as uint64"""
+    bits = frames[:, :, 1:] > frames[:, :, :-1]
+    return np.packbits(bits.reshape(len(frames), 64), axis=1).view(">u8").ravel().astype(np.uint64)
+
+
+def _seek_frames(filename, times, duration):
+    """Gray 9x8 frames of the first keyframe at or after each of times
+
+    A single ffmpeg process opens the file once per sample, seeking each input
+    to its time, so only the data around each sample is read. ffmpeg reads
+    the file itself, so the governor is charged an estimate of those reads up
+    front. Returns the raw frames, or None if ffmpeg failed.
+    """
+    try:
+        size = os.path.getsize(filename)
+        governor.charge(
+            opens=len(times),
+            nbytes=min(size, int(len(times) * _SEEK_READ_SECONDS * size / max(duration, 1e-3))),
+        )
+        samples = [
+            ffmpeg.input(filename, ss=t, skip_frame="nokey")
+            .video
+            .filter("scale", 9, 8)
+            .filter("setsar", 1)
+            .trim(end_frame=1)
+            for t in times
+        ]
+        out, _ = (
+            ffmpeg
+            .concat(*samples, v=1, a=0)
+            .output("pipe:", format="rawvideo", pix_fmt="gray", vframes=len(times))
+            .global_args("-loglevel", "quiet", "-nostats")
+            .run(capture_stdout=True)
+        )
+    except (ffmpeg.Error, OSError):
+        return None
+    return out
+
+
+def _stream_frames(filename, start, interval, max_frames):
+    """Gray 9x8 keyframes every interval seconds from start, decoding the whole file
+
+    The fallback for files ffmpeg can't seek in. The file is fed to ffmpeg
+    through stdin so the governor paces the reads, except for files it has to
+    seek around in, which it must read itself. Returns the raw frames, or None
+    if ffmpeg failed.
+    """
+    try:
+        with governor.open(filename) as f:
+            piped = not (os.path.splitext(filename)[1].lower() in _ISO_EXTENSIONS and _index_at_end(f))
+            if piped:
+                f.seek(0)
+            else:
+                governor.charge(nbytes=os.path.getsize(filename))
+            process = (
+                ffmpeg
+                .input("pipe:" if piped else filename, ss=start, skip_frame="nokey")
+                .filter("fps", fps=1 / interval)
+                .filter("scale", 9, 8)
+                .output("pipe:", format="rawvideo", pix_fmt="gray", vframes=max_frames)
+                .global_args("-loglevel", "quiet", "-nostats")
+                .run_async(pipe_stdin=piped, pipe_stdout=True)
+            )
+            if piped:
+                feeder = threading.Thread(target=_feed, args=(f, process.stdin), daemon=True)
+                feeder.start()
+            out = process.stdout.read()
+            process.wait()
+            if piped:
+                feeder.join()
+    except (ffmpeg.Error, OSError, struct.error):
+        return None
+    if process.returncode:
+        return None
+    return out
+
+
+def fingerprint(filename, max_frames=16, min_interval=2.0):
+    """Fingerprint a single video file
+
+    Keyframes are sampled every max(min_interval, duration / max_frames)
+    seconds, starting half an interval in, by seeking to each sample time. Using the same interval for clips of
+    similar length lets trimmed copies share most of their sampled frames.
+
+    Returns a dict with filename, duration, width, height and an array of frame
+    hashes, or None if the file could not be read as a video.
+    """
+    try:
+        governor.charge(opens=1)
+        probe = ffmpeg.probe(filename)
+        stream = next(s for s in probe["streams"] if s["codec_type"] == "video")
+        duration = float(probe["format"]["duration"])
+        width, height = int(stream["width"]), int(stream["height"])
+    except (ffmpeg.Error, StopIteration, KeyError, ValueError):
+        return None
+
+    interval = max(min_interval, duration / max_frames)
+    start = min(interval / 2, duration / 2)
+    times = [start + k * interval for k in range(max_frames) if start + k * interval < duration]
+    out = _seek_frames(filename, times, duration)
+    if not out:
+        out = _stream_frames(filename, start, interval, max_frames)
+    if out is None:
+        return None
+
+    frames = np.frombuffer(out, dtype=np.uint8)
+    frames = frames[:len(frames) // 72 * 72].reshape(-1, 8, 9)
+    return {
+        "filename": filename,
+        "duration": duration,
+        "width": width,
+        "height": height,
+        "hashes": dhash(frames),
+    }
+
+
+def fingerprint_videos(filenames, workers=None, **kwargs):
+    """Generator over the fingerprints of many videos, run across a pool of workers
+
+    Each worker just waits on an ffmpeg process, so threads are enough.
+    Fingerprints are yielded as they complete, with None for unreadable files.
+    Only a couple of files per worker are in flight at once, so filenames can
+    be a lazy iterable of any length.
+    """
+    workers = workers or os.cpu_count()
+    filenames = iter(filenames)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {
+            executor.submit(fingerprint, filename, **kwargs)
+            for filename in itertools.islice(filenames, 2 * workers)
+        }
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                for filename in itertools.islice(filenames, 1):
+                    pending.add(executor.submit(fingerprint, filename, **kwargs))
+                yield future.result()
+
+
+def _matching_frames(a, b, max_distance):
+    """Number of frame hashes in a within max_distance bits of one in b"""
+    distances = np.unpackbits(
+        (a[:, None] ^ b[None, :]).view(np.uint8).reshape(len(a), len(b), 8),
+        axis=2,
+    ).sum(axis=2)
+    return np.count_nonzero(distances.min(axis=1) <= max_distance)
+
+
+def group_videos(fingerprints, max_distance=10, min_overlap=0.5, max_bucket=1000, max_memory=None):
+    """Group fingerprints of the same clip
+
+    Candidate pairs share an exact 16-bit band of some frame hash. A pair is
+    kept when the videos have about the same aspect ratio and at least
+    min_overlap of the shorter video's frames are within max_distance bits of a
+    frame in the other. Bands shared by more than max_bucket videos are
+    ignored as uninformative.
+
+    The band buckets are grouped with make_grouper(max_memory), so they can
+    spill to disk. The frame hashes, aspect ratio and filename of every video
+    are still kept in memory to compare candidates, a few hundred bytes each.
+
+    Returns a dict mapping a group key to the filenames in each group.
+    """
+    filenames = []
+    aspects = []
+    hashes = []
+    with make_grouper(max_memory) as buckets:
+        for fp in fingerprints:
+            if fp is None:
+                continue
+            i = len(filenames)
+            filenames.append(fp["filename"])
+            aspects.append(fp["width"] / max(fp["height"], 1))
+            hashes.append(fp["hashes"])
+            for h in fp["hashes"]:
+                if int(h) in _FLAT_HASHES:
+                    continue
+                for band in range(4):
+                    buckets.add((band, (int(h) >> (16 * band)) & 0xFFFF), i)
+
+        linked = {}
+
+        def find(i):
+            while linked.get(i, i) != i:
+                i = linked[i]
+            return i
+
+        for _, videos in buckets.groups():
+            videos = sorted(set(videos))
+            if not 1 < len(videos) <= max_bucket:
+                continue
+            for j, a in enumerate(videos):
+                for b in videos[j + 1:]:
+                    # Pairs sharing several bands are only compared until linked
+                    if find(a) == find(b):
+                        continue
+                    aspect_a, aspect_b = aspects[a], aspects[b]
+                    if abs(aspect_a - aspect_b) > 0.05 * max(aspect_a, aspect_b):
+                        continue
+                    ha, hb = hashes[a], hashes[b]
+                    if len(ha) > len(hb):
+                        ha, hb = hb, ha
+                    matches = _matching_frames(ha, hb, max_distance)
+                    if matches and matches >= min_overlap * len(ha):
+                        linked.setdefault(a, a)
+                        linked.setdefault(b, b)
+                        linked[find(a)] = find(b)
+
+    groups = defaultdict(list)
+    for i in linked:
+        groups[find(i)].append(filenames[i])
+    return {
+        "video:{}".format(min(group)): sorted(group)
+        for group in groups.values()
+    }